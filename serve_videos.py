@@ -6,7 +6,7 @@ Run:
     python serve_videos_webinput.py
 
 Features:
-- Starts a Flask server on 0.0.0.0:8000
+- Starts a Flask server on 0.0.0.0:8000 (served by waitress when installed: pip install waitress)
 - First visit shows a form to input the folder path (no CLI args required)
 - Builds full, percent-encoded streaming URLs for every video in the folder
 - The visible URLs are "sanitized" (parentheses removed) to avoid client issues,
@@ -14,18 +14,48 @@ Features:
 - Provides a downloadable M3U playlist of the sanitized URLs
 """
 
+import hashlib
+import mimetypes
 import os
+import re
 import socket
+import unicodedata
 import urllib.parse
+from collections import Counter
 from pathlib import Path
-from flask import Flask, render_template_string, request, redirect, url_for, send_from_directory, Response, flash
+from typing import Optional
+from flask import Flask, render_template, request, redirect, url_for, send_from_directory, send_file, Response, flash, make_response
+from werkzeug.wsgi import wrap_file
+
+try:
+    from flask_compress import Compress   # optional: pip install flask-compress
+except ImportError:
+    Compress = None
 
 app = Flask(__name__)
 app.secret_key = "local-video-server-secret"  # only used for flash messages (local use only)
 
+# gzip only the text pages that opt in via @compressed; video responses are never compressed
+app.config['COMPRESS_REGISTER'] = False
+app.config['COMPRESS_MIMETYPES'] = ['text/html', 'audio/x-mpegurl']
+compress = Compress(app) if Compress else None
+
+def compressed(view):
+    """Compress the view's response when Flask-Compress is available, otherwise leave it as is."""
+    return compress.compressed()(view) if compress else view
+
 PORT = 8000
 HOST = "0.0.0.0"
 
+# Optional: hand file delivery off to a front-end web server instead of streaming from Python.
+# nginx: set USE_XACCEL = True and proxy to this app with an internal location pointing at the video folder:
+#     location /_internal/ { internal; alias /path/to/videos/; sendfile on; }
+# Apache (mod_xsendfile): set app.config['USE_X_SENDFILE'] = True instead.
+USE_XACCEL = False
+XACCEL_PREFIX = "/_internal/"
+
+STREAM_CHUNK_SIZE = 64 * 1024   # bytes per read when streaming a byte range
+
 HTML_SETUP = r"""
 <!doctype html>
 <html>
@@ -111,10 +141,18 @@ HTML_INDEX = r"""
 </html>
 """
 
+# compile the page templates once; render_template() accepts the compiled Template directly
+_TPL_SETUP = app.jinja_env.from_string(HTML_SETUP)
+_TPL_INDEX = app.jinja_env.from_string(HTML_INDEX)
+
 # runtime configuration
 app.config['VIDEO_DIR'] = None
-app.config['SANITIZED_MAP'] = {}   # sanitized_key -> actual filename
-app.config['HOST_IP'] = None
+app.config['SANITIZED_MAP'] = {}   # actual filename -> sanitized key
+app.config['REVERSE_MAP'] = {}     # sanitized key -> actual filename (for O(1) lookups in serve_by_key)
+app.config['FILES'] = []           # cached index listing, built once in set_folder
+app.config['STAT_MAP'] = {}        # actual filename -> (st_size, st_mtime) captured in set_folder
+app.config['M3U_BODY'] = "#EXTM3U\n"   # cached playlist, built once in set_folder
+app.config['INDEX_ETAG'] = None    # validator for the cached listing
 
 def get_local_ip():
     """Return a LAN IP address for the current machine (best-effort)."""
@@ -127,36 +165,64 @@ def get_local_ip():
     except Exception:
         return "127.0.0.1"
 
-VIDEO_EXTS = {'.mp4', '.mkv', '.avi', '.mov', '.flv', '.wmv', '.webm', '.m4v'}
+app.config['HOST_IP'] = get_local_ip()   # resolved once at startup; refreshed on /reset
 
-def is_video_file(p: Path) -> bool:
-    return p.suffix.lower() in VIDEO_EXTS
+VIDEO_EXTS = ('.mp4', '.mkv', '.avi', '.mov', '.flv', '.wmv', '.webm', '.m4v')
+_EXT_TAIL = max(len(e) for e in VIDEO_EXTS)
+
+def is_video_file(name: str) -> bool:
+    # lower-case only the last few characters, then one C-level endswith over the tuple
+    return name[-_EXT_TAIL:].lower().endswith(VIDEO_EXTS)
+
+_DROP = str.maketrans('', '', '()')
 
 def sanitize_visible(name: str) -> str:
-    """Remove parentheses from visible filename and collapse double spaces."""
-    s = name.replace('(', '').replace(')', '')
+    """Remove parentheses from visible filename, collapse double spaces and NFC-normalize."""
+    s = unicodedata.normalize('NFC', name)
+    s = s.translate(_DROP)
     # optionally remove other trouble characters (keep commas and apostrophes if you like)
-    s = " ".join(s.split())
+    # only re-split when there is whitespace to collapse: runs of spaces, leading/trailing
+    # spaces, or non-space whitespace (str.isprintable() is False for all of it)
+    if '  ' in s or s[:1] == ' ' or s[-1:] == ' ' or not s.isprintable():
+        s = " ".join(s.split())
     return s
 
+# characters urllib.parse.quote(..., safe='') never escapes
+_UNRESERVED_RE = re.compile(r"[A-Za-z0-9_.~-]*")
+
+def encode_key(key: str) -> str:
+    """Percent-encode a sanitized key for use as a single URL path segment."""
+    if _UNRESERVED_RE.fullmatch(key):
+        return key
+    # same output as quote(key, safe=''), minus quote()'s str argument handling
+    return urllib.parse.quote_from_bytes(key.encode('utf-8'), safe=b'')
+
 @app.route("/", methods=["GET"])
+@compressed
 def root():
     if not app.config['VIDEO_DIR']:
-        return render_template_string(HTML_SETUP, port=PORT, ip=get_local_ip())
-    # build listing
+        return render_template(_TPL_SETUP, port=PORT, ip=app.config['HOST_IP'])
+    etag = app.config['INDEX_ETAG']
+    client_tags = request.if_none_match
+    if etag in client_tags:
+        matched = etag
+    else:
+        # Flask-Compress suffixes the ETag of compressed bodies with ":<algorithm>"
+        matched = next((t for t in client_tags.as_set() if t.startswith(etag + ':')), None)
+    if matched:
+        # listing unchanged since the client's copy: skip rendering entirely,
+        # repeating the validator that client was sent
+        resp = Response(status=304)
+        resp.set_etag(matched)
+        return resp
     folder = Path(app.config['VIDEO_DIR'])
-    files = []
-    host_ip = app.config['HOST_IP'] or get_local_ip()
-    for p in sorted(folder.iterdir()):
-        if p.is_file() and is_video_file(p):
-            actual_name = p.name
-            # get sanitized key used in URL
-            sanitized_key = urllib.parse.quote(app.config['SANITIZED_MAP'].get(actual_name, actual_name), safe='')
-            url = f"http://{host_ip}:{PORT}/files/{sanitized_key}"
-            display_name = app.config['SANITIZED_MAP'].get(actual_name, actual_name)
-            files.append({"display_name": display_name, "url": url})
-    server_url = f"http://{get_local_ip()}:{PORT}/"
-    return render_template_string(HTML_INDEX, files=files, server_url=server_url, folder_name=folder.name)
+    host_ip = app.config['HOST_IP']
+    server_url = f"http://{host_ip}:{PORT}/"
+    resp = make_response(render_template(_TPL_INDEX, files=app.config['FILES'], server_url=server_url, folder_name=folder.name))
+    resp.set_etag(etag)
+    # "/" switches between setup page and listings on /reset and /set_folder: always revalidate
+    resp.cache_control.no_cache = True
+    return resp
 
 @app.route("/set_folder", methods=["POST"])
 def set_folder():
@@ -169,69 +235,212 @@ def set_folder():
         flash("Folder does not exist or is not a directory. Check the path and try again.")
         return redirect(url_for('root'))
 
-    # build sanitized map: sanitized_display -> actual filename
+    # build sanitized map: actual filename -> sanitized display key
     sanitized_map = {}
-    collisions = {}
-    for p in sorted(folder_path.iterdir()):
-        if p.is_file() and is_video_file(p):
-            actual = p.name
-            sanitized = sanitize_visible(actual)
-            # ensure uniqueness: if collision, append an index
-            key = sanitized
-            i = 1
-            while key in sanitized_map.values():
-                i += 1
-                key = f"{sanitized} {i}"
-            sanitized_map[actual] = key
-
-    app.config['VIDEO_DIR'] = str(folder_path.resolve())
+    used = set()   # casefolded keys already assigned
+    last_index = Counter()   # casefolded base name -> last suffix handed out for it
+    # scandir's DirEntry.is_file() uses the cached d_type, so filtering needs no stat
+    with os.scandir(folder) as it:
+        entries = [e for e in it if e.is_file() and is_video_file(e.name)]
+    entries.sort(key=lambda e: e.name)
+    # each video is stat'ed once here (a syscall per entry on POSIX) so file requests don't have to;
+    # the folder is treated as static once loaded; reload it to pick up changed files
+    stat_map = {}
+    for e in entries:
+        actual = e.name
+        st = e.stat()
+        stat_map[actual] = (st.st_size, st.st_mtime)
+        sanitized = sanitize_visible(actual)
+        # ensure uniqueness: if collision, append an index
+        # (compared case-insensitively so "Movie.mkv" and "MOVIE.mkv" get distinct keys)
+        # set membership probes by the string's cached hash and only compares full strings on a hash match
+        # repeated base names resume after their last suffix instead of re-probing from 2
+        base = sanitized.casefold()
+        i = last_index[base] + 1
+        key = sanitized if i == 1 else f"{sanitized} {i}"
+        folded = key.casefold()
+        while folded in used:
+            i += 1
+            key = f"{sanitized} {i}"
+            folded = key.casefold()
+        last_index[base] = i
+        used.add(folded)
+        sanitized_map[actual] = key
+
+    # percent-encode each key once; index and playlist reuse it
+    encoded_map = {actual: encode_key(sanitized) for actual, sanitized in sanitized_map.items()}
+    # build listing once; the index page just renders it
+    host_ip = app.config['HOST_IP']
+    files = [{"display_name": sanitized, "url": f"http://{host_ip}:{PORT}/files/{encoded_map[actual]}"}
+             for actual, sanitized in sanitized_map.items()]
+    m3u_body = "\n".join(["#EXTM3U", *(f["url"] for f in files)]) + "\n"
+    # the page only changes with the folder, host address or file keys
+    video_dir = str(folder_path.resolve())
+    etag_src = "\n".join([video_dir, host_ip, *sanitized_map.values()])
+    etag = hashlib.md5(etag_src.encode('utf-8')).hexdigest()
+
+    app.config['VIDEO_DIR'] = video_dir
     app.config['SANITIZED_MAP'] = sanitized_map
-    app.config['HOST_IP'] = get_local_ip()
+    app.config['REVERSE_MAP'] = {v: k for k, v in sanitized_map.items()}
+    app.config['STAT_MAP'] = stat_map
+    app.config['FILES'] = files
+    app.config['M3U_BODY'] = m3u_body
+    app.config['INDEX_ETAG'] = etag
     return redirect(url_for('root'))
 
 @app.route("/reset", methods=["GET"])
 def reset():
     app.config['VIDEO_DIR'] = None
     app.config['SANITIZED_MAP'] = {}
+    app.config['REVERSE_MAP'] = {}
+    app.config['STAT_MAP'] = {}
+    app.config['FILES'] = []
+    app.config['M3U_BODY'] = "#EXTM3U\n"
+    app.config['INDEX_ETAG'] = None
+    app.config['HOST_IP'] = get_local_ip()
     return redirect(url_for('root'))
 
+# single "bytes=start-[end]" range, the form video players send when seeking
+_RANGE_RE = re.compile(r"bytes=(\d+)-(\d*)")
+
+def send_range(path: str, size: int, mtime: float, start: int, end: Optional[int]) -> Response:
+    """Stream bytes start..end (inclusive) of path as a 206 response, seeking straight to start."""
+    f = open(path, 'rb')
+    # the cached size may be stale (e.g. a file still being written); never promise more than is there
+    size = min(size, os.fstat(f.fileno()).st_size)
+    if end is None or end >= size:
+        end = size - 1
+    if start > end:
+        f.close()
+        return Response("Requested range not satisfiable", 416, headers={"Content-Range": f"bytes */{size}"})
+    f.seek(start)
+    length = end - start + 1
+    mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+
+    file_wrapper = request.environ.get('wsgi.file_wrapper')
+    if request.method == 'HEAD':
+        # no body is sent, and werkzeug would not hand the file to the server to close
+        f.close()
+        resp = Response(b'', 206, mimetype=mimetype)
+    elif file_wrapper is not None and end == size - 1:
+        # the range runs to EOF, so the pre-seeked file can go straight to the server
+        # (which also closes it); wrappers such as wsgiref's read to EOF and ignore Content-Length
+        resp = Response(file_wrapper(f, STREAM_CHUNK_SIZE), 206, mimetype=mimetype, direct_passthrough=True)
+    else:
+        def generate():
+            remaining = length
+            while remaining > 0:
+                chunk = f.read(min(STREAM_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+        resp = Response(generate(), 206, mimetype=mimetype)
+        resp.call_on_close(f.close)
+    resp.headers['Content-Range'] = f"bytes {start}-{end}/{size}"
+    resp.headers['Accept-Ranges'] = 'bytes'
+    resp.content_length = length
+    resp.last_modified = mtime
+    # /files/<key> can point at a different file after a folder (re)load
+    resp.cache_control.no_cache = True
+    return resp
+
+def send_full(path: str, size: int, mtime: float) -> Response:
+    """Send the whole file as a passthrough response so the WSGI server's file wrapper streams it."""
+    f = open(path, 'rb')
+    if not f.seekable():
+        f.close()
+        return send_file(path, conditional=True)
+    # the cached size may be stale; never promise more than is there
+    size = min(size, os.fstat(f.fileno()).st_size)
+    mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    resp = Response(wrap_file(request.environ, f, STREAM_CHUNK_SIZE), mimetype=mimetype, direct_passthrough=True)
+    resp.content_length = size
+    resp.last_modified = mtime
+    # validator for If-None-Match and ETag-based If-Range, as send_from_directory provided
+    resp.set_etag(f"{mtime}-{size}")
+    # keys can point at a different file after a folder (re)load, as send_from_directory assumed
+    resp.cache_control.no_cache = True
+    # handles any range form send_range() leaves to us
+    try:
+        resp = resp.make_conditional(request, accept_ranges=True, complete_length=size)
+    except Exception:
+        # e.g. 416 raised for an unsatisfiable range: the response (and file) is discarded
+        f.close()
+        raise
+    if request.method == 'HEAD' or resp.status_code == 304:
+        # no body is sent, so nothing downstream will close the file
+        f.close()
+    return resp
+
 @app.route("/files/<path:key>")
 def serve_by_key(key):
     """Key is the sanitized (and percent-encoded) identifier. Map back to actual filename."""
-    # percent-decode key to match sanitized_map values
-    decoded = urllib.parse.unquote(key)
-    folder = Path(app.config['VIDEO_DIR'])
-    # find actual filename whose sanitized value equals decoded
-    found = None
-    for actual, sanitized in app.config['SANITIZED_MAP'].items():
-        if sanitized == decoded:
-            found = actual
-            break
+    # the <path:key> converter has already percent-decoded the key; decoding again would
+    # mangle names containing a literal '%' (e.g. "50%41.mkv" served as /files/50%2541.mkv)
+    decoded = key
+    found = app.config['REVERSE_MAP'].get(decoded)
     if not found:
-        # fallback: try matching actual filename directly
-        for p in folder.iterdir():
-            if p.name == decoded:
-                found = p.name
-                break
+        # fallback: try matching actual filename directly (plain names only, no sub-paths)
+        if os.path.basename(decoded) == decoded and os.path.isfile(os.path.join(app.config['VIDEO_DIR'], decoded)):
+            found = decoded
     if not found:
         return "File not found", 404
-    # send the real file (Flask will handle range requests)
-    return send_from_directory(app.config['VIDEO_DIR'], found, conditional=True)
+    path = os.path.join(app.config['VIDEO_DIR'], found)
+    # (size, mtime) recorded by set_folder, so range requests don't stat the file again
+    cached = app.config['STAT_MAP'].get(found)
+    if cached is None:
+        try:
+            st = os.stat(path)
+        except OSError:
+            return "File not found", 404
+        cached = (st.st_size, st.st_mtime)
+    size, mtime = cached
+    ims = request.if_modified_since
+    if ims and 'If-None-Match' not in request.headers and int(mtime) <= ims.timestamp():
+        resp = Response(status=304)
+        resp.last_modified = mtime
+    elif USE_XACCEL:
+        # empty body; nginx serves the file itself (ranges, sendfile) from its internal location
+        mimetype = mimetypes.guess_type(found)[0] or 'application/octet-stream'
+        resp = Response(mimetype=mimetype)
+        resp.headers['X-Accel-Redirect'] = XACCEL_PREFIX + urllib.parse.quote(found)
+    elif app.config['USE_X_SENDFILE']:
+        # Flask emits the X-Sendfile header for Apache
+        resp = send_from_directory(app.config['VIDEO_DIR'], found, conditional=True)
+    else:
+        m = _RANGE_RE.fullmatch(request.headers.get('Range', ''))
+        try:
+            if m and 'If-Range' not in request.headers:
+                end = int(m.group(2)) if m.group(2) else None
+                resp = send_range(path, size, mtime, int(m.group(1)), end)
+            else:
+                # full file, conditional requests and other range forms
+                resp = send_full(path, size, mtime)
+        except OSError:
+            # renamed or deleted since the folder was loaded: the cached stat is dead too
+            app.config['STAT_MAP'].pop(found, None)
+            return "File not found", 404
+    # video is already compressed; mark it so no compression layer (app or proxy) re-encodes it
+    resp.headers['Content-Encoding'] = 'identity'
+    resp.headers['Accept-Ranges'] = 'bytes'
+    return resp
 
 @app.route("/playlist.m3u")
+@compressed
 def playlist_m3u():
-    folder = Path(app.config['VIDEO_DIR'])
-    lines = ["#EXTM3U"]
-    host_ip = app.config['HOST_IP'] or get_local_ip()
-    for actual, sanitized in app.config['SANITIZED_MAP'].items():
-        encoded = urllib.parse.quote(sanitized, safe='')
-        url = f"http://{host_ip}:{PORT}/files/{encoded}"
-        lines.append(url)
-    body = "\n".join(lines) + "\n"
-    return Response(body, mimetype="audio/x-mpegurl", headers={"Content-Disposition": f"attachment; filename=videos.m3u"})
+    return Response(app.config['M3U_BODY'], mimetype="audio/x-mpegurl", headers={"Content-Disposition": f"attachment; filename=videos.m3u"})
 
 if __name__ == "__main__":
     print("Starting server on 0.0.0.0:%d" % PORT)
     print("Open on this machine: http://localhost:%d/" % PORT)
-    print("Open on another device: http://%s:%d/" % (get_local_ip(), PORT))
-    app.run(host=HOST, port=PORT, debug=False, threaded=True)
+    print("Open on another device: http://%s:%d/" % (app.config['HOST_IP'], PORT))
+    try:
+        from waitress import serve
+    except ImportError:
+        # waitress not installed: fall back to Flask's development server
+        app.run(host=HOST, port=PORT, debug=False, threaded=True)
+    else:
+        # waitress exposes wsgi.file_wrapper, which send_full/send_range hand the open file to
+        serve(app, host=HOST, port=PORT, threads=8)